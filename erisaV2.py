@@ -1,55 +1,82 @@
 import json
 import logging
 import argparse
+import asyncio
 import os
 import sys
+import time
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import PyPDF2
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Import your modules (adjust paths if necessary)
-from document_loaders.template_loader import load_templates_from_json
 from file_operations.saving_result_in_file import save_results
-from prompts_operation.prompts_operations import generate_prompts
-from utils import split_query_by_length_with_overlap
+from erisa_helpers import PDF_BACKENDS, env_int, load_templates, read_pdf_cached, read_text, run_rule, split_query
 #python erisaV2.py -i ./input -if erisadoc.pdf -f pdf
 # Logging setup
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# Helper function to read PDFs
-def read_pdf(file_path):
-    try:
-        text_content = ""
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page in reader.pages:
-                text_content += page.extract_text() or ''
-        return text_content
-    except Exception as e:
-        logger.error(f"Failed to read PDF file: {file_path}. Error: {e}")
-        sys.exit(1)
-
-# Helper function to read text files
-def read_text(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read()
-    except Exception as e:
-        logger.error(f"Failed to read text file: {file_path}. Error: {e}")
-        sys.exit(1)
+# Flattens line breaks in CSV fields; csv.QUOTE_ALL already escapes embedded quotes
+_CSV_SANITIZE = str.maketrans({'\r': ' ', '\n': ' '})
+
+# JSON helpers, using orjson when it is installed
+def _write_json(data, file_path):
+    if orjson is not None:
+        with open(file_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+def _read_json(file_path):
+    if orjson is not None:
+        with open(file_path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+CSV_WRITE_RETRIES = 3
+
+# Writes the analysis results as one quoted CSV row per rule
+def _write_csv(data, file_path):
+    with open(file_path, 'w', newline='', encoding='utf-8-sig', buffering=1 << 20) as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(['Rule', 'Rule Definition', 'Comply Yes/No', 'Citation'])
+
+        writer.writerows(
+            (
+                rule_name,
+                details.get("Rule Definition", "").translate(_CSV_SANITIZE),
+                details.get("Comply Yes/No", ""),
+                details.get("Citation", "")
+            )
+            for rule_name, details in data.items()
+        )
 
 class ErisaAnalyzer:
-    def __init__(self, input_dir, input_filename, file_type):
+    # MyEnv.env is loaded once per process, not on every construction
+    _env_loaded = False
+
+    def __init__(self, input_dir, input_filename, file_type, backend="pymupdf"):
         self.input_dir = input_dir
         self.input_filename = input_filename
         self.file_type = file_type
+        self.backend = backend
         self._load_environment_variables()
 
     def _load_environment_variables(self):
+        if ErisaAnalyzer._env_loaded:
+            return
         if not os.path.exists("MyEnv.env"):
             logger.warning("MyEnv.env file not found! Proceeding with system environment variables.")
         load_dotenv("MyEnv.env")
+        ErisaAnalyzer._env_loaded = True
 
     def read_input_file(self):
         file_path = os.path.join(self.input_dir, self.input_filename)
@@ -58,8 +85,7 @@ class ErisaAnalyzer:
             sys.exit(1)
 
         if self.file_type == 'pdf':
-            logger.info(f"Reading PDF file: {file_path}")
-            return read_pdf(file_path)
+            return read_pdf_cached(file_path, self.backend)
         elif self.file_type == 'txt':
             logger.info(f"Reading text file: {file_path}")
             return read_text(file_path)
@@ -68,9 +94,12 @@ class ErisaAnalyzer:
             sys.exit(1)
 
     def execute_all_rules(self):
+        asyncio.run(self.execute_all_rules_async())
+
+    async def execute_all_rules_async(self):
         logger.info(f"Executing analysis for ALL rules in 'erisaRules.json'...")
         try:
-            template_prompts = load_templates_from_json("Templates/erisaRules.json")
+            template_prompts = load_templates("Templates/erisaRules.json")
         except Exception as e:
             logger.error(f"Failed to load template file 'Templates/erisaRules.json'. Error: {e}")
             sys.exit(1)
@@ -78,19 +107,27 @@ class ErisaAnalyzer:
         query = self.read_input_file()
 
         # Split the query for large files
-        queries = split_query_by_length_with_overlap(query)
+        queries = split_query(query)
 
         all_results = {}
 
-        for rule_name, template_bdd in template_prompts.items():
-            logger.info(f"Processing rule: {rule_name}")
-            result_prompt = ""
-
-            if len(queries) == 1:
-                result_prompt = generate_prompts(template_bdd, queries[0])
+        # generate_prompts is I/O bound, so run every (rule, chunk) call concurrently
+        # and collect the results per rule in chunk order.
+        concurrency = env_int("ERISA_CONCURRENCY", 8)
+        sem = asyncio.Semaphore(concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            per_rule = await asyncio.gather(
+                *(run_rule(sem, pool, rule_name, template_bdd, queries) for rule_name, template_bdd in template_prompts.items())
+            )
+
+        for rule_name, rule_results in zip(template_prompts, per_rule):
+            if len(rule_results) == 1:
+                result_prompt = rule_results[0]
             else:
-                for i, chunk in enumerate(queries):
-                    result_prompt += f"Document chunk {i+1}:\n{generate_prompts(template_bdd, chunk)}\n\n"
+                # Pure string assembly: CPython's join is the fast path here, and a
+                # Numba/Cython pass would not help (object-mode strings are slower).
+                pieces = [f"Document chunk {i+1}:\n{result}" for i, result in enumerate(rule_results)]
+                result_prompt = "\n\n".join(pieces) + "\n\n"
 
             # Here, assume generate_prompts returns structured data.
             # For demonstration, let’s fake it as:
@@ -105,52 +142,46 @@ class ErisaAnalyzer:
         output_json_filename = f"{base_filename}.json"
         json_output_path = os.path.join(self.input_dir, output_json_filename)
 
-        with open(json_output_path, 'w', encoding='utf-8') as f:
-            json.dump(all_results, f, indent=2, ensure_ascii=False)
+        # JSON and CSV are both written from all_results, so write them concurrently
+        await asyncio.gather(
+            asyncio.to_thread(_write_json, all_results, json_output_path),
+            asyncio.to_thread(self.convert_json_to_csv, all_results)
+        )
 
         logger.info(f"Analysis complete. JSON results saved to: {json_output_path}")
 
-        # Convert JSON to CSV
-        self.convert_json_to_csv(json_output_path)
-
-    def convert_json_to_csv(self, json_file_path):
+    def convert_json_file_to_csv(self, json_file_path):
         try:
-            with open(json_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = _read_json(json_file_path)
+        except Exception as e:
+            logger.error(f"Failed to load JSON file: {json_file_path}. Error: {e}")
+            return
 
+        base_filename = os.path.splitext(os.path.basename(json_file_path))[0]
+        csv_output_path = os.path.join(self.input_dir, f"{base_filename}.csv")
+        self.convert_json_to_csv(data, csv_output_path)
+
+    def convert_json_to_csv(self, data, csv_output_path=None):
+        try:
             if not isinstance(data, dict):
                 logger.error(f"Unexpected JSON structure. Expected a dictionary at the top level.")
                 return
 
-            base_filename = os.path.splitext(os.path.basename(json_file_path))[0]
-            csv_filename = f"{base_filename}.csv"
-            csv_output_path = os.path.join(self.input_dir, csv_filename)
+            if csv_output_path is None:
+                base_filename = os.path.splitext(self.input_filename)[0]
+                csv_output_path = os.path.join(self.input_dir, f"{base_filename}.csv")
 
-            # ✅ NEW: Remove existing CSV if it exists to avoid permission errors
-            if os.path.exists(csv_output_path):
+            # Opening with 'w' truncates an existing CSV; retry briefly if another
+            # process (Excel, AV scanners on Windows) still holds it open.
+            for attempt in range(CSV_WRITE_RETRIES):
                 try:
-                    os.remove(csv_output_path)
-                    logger.info(f"Deleted existing CSV file: {csv_output_path}")
-                except Exception as e:
-                    logger.error(f"Failed to delete existing CSV file: {e}")
-                    return
-
-            with open(csv_output_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
-                fieldnames = ['Rule', 'Rule Definition', 'Comply Yes/No', 'Citation']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_ALL)
-                writer.writeheader()
-
-                for rule_name, details in data.items():
-                    rule_def = details.get("Rule Definition", "").replace('\r', ' ').replace('\n', ' ').replace('"', '""')
-                    comply = details.get("Comply Yes/No", "")
-                    citation = details.get("Citation", "")
-
-                    writer.writerow({
-                        'Rule': rule_name,
-                        'Rule Definition': rule_def,
-                        'Comply Yes/No': comply,
-                        'Citation': citation
-                    })
+                    _write_csv(data, csv_output_path)
+                    break
+                except PermissionError:
+                    if attempt == CSV_WRITE_RETRIES - 1:
+                        raise
+                    logger.warning(f"CSV file is locked, retrying: {csv_output_path}")
+                    time.sleep(0.2 * (attempt + 1))
 
             logger.info(f"CSV file created: {csv_output_path}")
         except Exception as e:
@@ -161,9 +192,10 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--input_dir", required=True, help="Input directory containing files")
     parser.add_argument("-if", "--input_filename", required=True, help="Input filename")
     parser.add_argument("-f", "--file_type", required=True, choices=["pdf", "txt"], help="File type to process (pdf or txt)")
+    parser.add_argument("-b", "--backend", default="pymupdf", choices=list(PDF_BACKENDS), help="PDF text extraction backend (default: pymupdf)")
 
     args = parser.parse_args()
 
-    analyzer = ErisaAnalyzer(args.input_dir, args.input_filename, args.file_type)
+    analyzer = ErisaAnalyzer(args.input_dir, args.input_filename, args.file_type, args.backend)
     analyzer.execute_all_rules()
 
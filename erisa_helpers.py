@@ -0,0 +1,290 @@
+# Shared helpers for the ERISA analysis scripts (erisaV2.py, erisav1.py)
+import json
+import logging
+import asyncio
+import os
+import sys
+import hashlib
+import shutil
+import subprocess
+import functools
+import contextlib
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+
+# Import your modules (adjust paths if necessary)
+from document_loaders.template_loader import load_templates_from_json
+from prompts_operation.prompts_operations import generate_prompts
+from utils import split_query_by_length_with_overlap
+
+logger = logging.getLogger(__name__)
+
+# Reads a positive integer setting from the environment, exiting on a bad value
+def env_int(name, default, minimum=1):
+    value = os.getenv(name, str(default))
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        logger.error(f"{name} must be an integer >= {minimum}, got {value!r}")
+        sys.exit(1)
+    return number
+
+# PDFs with at least this many pages (ERISA_PARALLEL_PAGE_THRESHOLD) are extracted in
+# parallel page slices. Each worker process re-imports this module and re-parses the xref,
+# so only very long documents are worth fanning out.
+PARALLEL_PAGE_THRESHOLD = 200
+
+# Upper bound on extraction processes (ERISA_PDF_WORKERS), whatever the core count
+PDF_MAX_WORKERS = 4
+
+# get_text("text") flags, pinned to PyMuPDF's own default. MuPDF has no text-only parsing
+# mode, so this does not skip graphics operators; it only keeps the output stable.
+_FITZ_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT
+
+def _read_pdf_page_range(file_path, start, stop):
+    with fitz.open(file_path) as doc:
+        return "".join(doc.load_page(i).get_text("text", flags=_FITZ_TEXT_FLAGS) for i in range(start, stop))
+
+# Reads the whole file with one unbuffered readinto into a preallocated buffer
+def _read_file_bytes(file_path):
+    with open(file_path, 'rb', buffering=0) as file:
+        size = os.fstat(file.fileno()).st_size
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            n = file.readinto(view[offset:])
+            if not n:
+                break
+            offset += n
+    return buf if offset == size else buf[:offset]
+
+def _read_pdf_pymupdf(file_path):
+    # Open once from a single read; only large documents are closed and re-opened by path
+    # in the worker processes below.
+    with fitz.open(stream=_read_file_bytes(file_path), filetype="pdf") as doc:
+        page_count = doc.page_count
+        threshold = env_int("ERISA_PARALLEL_PAGE_THRESHOLD", PARALLEL_PAGE_THRESHOLD)
+        max_workers = env_int("ERISA_PDF_WORKERS", PDF_MAX_WORKERS)
+        workers = min(max_workers, os.cpu_count() or 1, page_count)
+        if page_count < threshold or workers < 2:
+            parts = [page.get_text("text", flags=_FITZ_TEXT_FLAGS) for page in doc]
+            return "".join(parts)
+
+    # fitz.Document is not thread safe, so each worker process opens the file
+    # itself and extracts one contiguous slice of pages.
+    step = -(-page_count // workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_read_pdf_page_range, file_path, start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ]
+        parts = [future.result() for future in futures]
+    return "".join(parts)
+
+def _read_pdf_pypdfium2(file_path):
+    import pypdfium2 as pdfium
+    parts = []
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        # Close each page as soon as its text is taken to keep peak memory low
+        for page in pdf:
+            textpage = page.get_textpage()
+            parts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    return "".join(parts)
+
+def _read_pdf_pypdf2(file_path):
+    import PyPDF2
+    parts = []
+    with open(file_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        for page in reader.pages:
+            parts.append(page.extract_text() or '')
+    return "".join(parts)
+
+# PDF text extraction backends, selectable with -b/--backend
+PDF_BACKENDS = {
+    "pymupdf": _read_pdf_pymupdf,
+    "pypdfium2": _read_pdf_pypdfium2,
+    "pypdf2": _read_pdf_pypdf2,
+}
+
+# Uses poppler's pdftotext binary; returns None if it is missing or fails
+def _read_pdf_pdftotext(file_path):
+    pdftotext = shutil.which("pdftotext")
+    if pdftotext is None:
+        return None
+    try:
+        result = subprocess.run([pdftotext, "-layout", file_path, "-"], stdout=subprocess.PIPE, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"pdftotext failed for {file_path}, falling back to Python backend. Error: {e}")
+        return None
+    return result.stdout.decode("utf-8", errors="replace")
+
+# Helper function to read PDFs; returns the text and the name of the extractor that produced it
+def read_pdf_with_extractor(file_path, backend="pymupdf"):
+    if os.getenv("ERISA_USE_PDFTOTEXT") == "1":
+        text_content = _read_pdf_pdftotext(file_path)
+        if text_content is not None:
+            return text_content, "pdftotext"
+    try:
+        return PDF_BACKENDS[backend](file_path), backend
+    except Exception as e:
+        logger.error(f"Failed to read PDF file: {file_path}. Error: {e}")
+        sys.exit(1)
+
+def read_pdf(file_path, backend="pymupdf"):
+    return read_pdf_with_extractor(file_path, backend)[0]
+
+# Helper function to load rule templates, cached until the file's mtime changes
+_templates_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=8)
+def _cached_templates(path, mtime):
+    return load_templates_from_json(path)
+
+def load_templates(path):
+    with _templates_lock:
+        return _cached_templates(path, os.path.getmtime(path))
+
+# On-disk cache helpers, rooted at ERISA_CACHE_DIR (default ./.erisa_cache). The
+# *_cache_entry helpers log cache I/O errors and treat them as a miss, so a broken or
+# unwritable cache never stops an analysis.
+def cache_dir(kind):
+    path = os.path.join(os.getenv("ERISA_CACHE_DIR", "./.erisa_cache"), kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def write_cache_file(file_path, text):
+    # Write to a temp file first so concurrent readers never see a partial entry
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        os.replace(tmp_path, file_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+def read_cache_entry(kind, name):
+    try:
+        with open(os.path.join(cache_dir(kind), name), 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except (OSError, UnicodeDecodeError) as e:
+        logger.warning(f"Ignoring {kind} cache entry {name}. Error: {e}")
+        return None
+
+def write_cache_entry(kind, name, text):
+    try:
+        write_cache_file(os.path.join(cache_dir(kind), name), text)
+    except OSError as e:
+        logger.warning(f"Could not write {kind} cache entry {name}. Error: {e}")
+
+# Bump when prompts_operation changes so answers from the old prompt code are not reused
+PROMPT_CACHE_VERSION = 1
+
+# Completion settings that change the answer for the same (template, chunk)
+_PROMPT_CACHE_ENV_KEYS = ("OPENAI_MODEL_COMPLETION", "OPENAI_DEPLOYMENT_COMPLETION", "OPENAI_API_VERSION")
+
+# generate_prompts results are reused across runs, keyed by (template, chunk) content and the
+# completion model settings. Set ERISA_PROMPT_CACHE=0 to always call generate_prompts.
+def cached_generate_prompts(template_bdd, chunk):
+    if os.getenv("ERISA_PROMPT_CACHE", "1") == "0":
+        return generate_prompts(template_bdd, chunk)
+
+    key_parts = [PROMPT_CACHE_VERSION, *(os.getenv(name, "") for name in _PROMPT_CACHE_ENV_KEYS), template_bdd, chunk]
+    key_source = json.dumps(key_parts, ensure_ascii=False).encode('utf-8')
+    key = hashlib.blake2b(key_source, digest_size=16).hexdigest()
+    cached = read_cache_entry("prompts", key)
+    if cached is not None:
+        return cached
+
+    result = generate_prompts(template_bdd, chunk)
+    # Empty answers are usually failed calls; don't pin them in the cache
+    if isinstance(result, str) and result.strip():
+        write_cache_entry("prompts", key, result)
+    return result
+
+# Cheap fingerprint of a file: size, mtime and its first/last 4 KiB, plus any extra key parts
+def fingerprint(file_path, *extra):
+    st = os.stat(file_path)
+    with open(file_path, 'rb') as f:
+        head = f.read(4096)
+        f.seek(-min(4096, st.st_size), os.SEEK_END)
+        tail = f.read()
+    digest = hashlib.blake2b(head + tail, digest_size=16)
+    for part in (st.st_size, int(st.st_mtime), *extra):
+        digest.update(f"|{part}".encode('utf-8'))
+    return digest.hexdigest()
+
+# Reads a PDF, reusing text cached per file fingerprint and extractor
+def read_pdf_cached(file_path, backend="pymupdf"):
+    use_pdftotext = os.getenv("ERISA_USE_PDFTOTEXT") == "1" and shutil.which("pdftotext") is not None
+    extractor = "pdftotext" if use_pdftotext else backend
+    try:
+        file_fingerprint = fingerprint(file_path, extractor)
+    except OSError as e:
+        logger.warning(f"Could not fingerprint {file_path}, skipping the PDF text cache. Error: {e}")
+        file_fingerprint = None
+
+    if file_fingerprint is not None:
+        cached = read_cache_entry("pdftext", f"{file_fingerprint}.txt")
+        if cached is not None:
+            logger.info(f"Using cached text for PDF file: {file_path}")
+            return cached
+
+    logger.info(f"Reading PDF file: {file_path} (backend: {extractor})")
+    text_content, used_extractor = read_pdf_with_extractor(file_path, backend)
+    if file_fingerprint is not None:
+        # pdftotext may have failed and fallen back to the backend; file the text under what produced it
+        if used_extractor != extractor:
+            file_fingerprint = fingerprint(file_path, used_extractor)
+        write_cache_entry("pdftext", f"{file_fingerprint}.txt", text_content)
+    return text_content
+
+LARGE_TEXT_FILE_BYTES = 100 * 1024 * 1024
+
+# Helper function to read text files
+def read_text(file_path):
+    try:
+        if os.path.getsize(file_path) > LARGE_TEXT_FILE_BYTES:
+            with open(file_path, 'r', encoding='utf-8', buffering=1 << 20) as file:
+                return file.read()
+        return Path(file_path).read_text(encoding='utf-8')
+    except Exception as e:
+        logger.error(f"Failed to read text file: {file_path}. Error: {e}")
+        sys.exit(1)
+
+# Splits the query into chunks. ERISA_SINGLE_CHUNK_CHARS is opt-in and must not exceed
+# the splitter's own chunk length; texts up to that size then skip the splitter.
+def split_query(query):
+    single_chunk_chars = os.getenv("ERISA_SINGLE_CHUNK_CHARS")
+    if single_chunk_chars and len(query) <= int(single_chunk_chars):
+        return [query]
+    return split_query_by_length_with_overlap(query)
+
+# Runs one rule over every chunk; the semaphore bounds in-flight generate_prompts calls
+async def run_rule(sem, pool, rule_name, template_bdd, chunks):
+    loop = asyncio.get_running_loop()
+
+    async def run_chunk(i, chunk):
+        async with sem:
+            # Logged once the call actually starts, not when it is queued
+            if len(chunks) == 1:
+                logger.info(f"Processing rule: {rule_name}")
+            else:
+                logger.info(f"Processing rule: {rule_name} (chunk {i+1}/{len(chunks)})")
+            return await loop.run_in_executor(pool, cached_generate_prompts, template_bdd, chunk)
+
+    return await asyncio.gather(*(run_chunk(i, chunk) for i, chunk in enumerate(chunks)))